@@ -1,18 +1,32 @@
 import streamlit as st
 import os
+import io
 import uuid
+import time
+import queue
+import threading
 from datetime import datetime
-from utils.db import get_db_session, create_conversation, save_message, get_conversation_messages
+from utils.db import get_db_session, ensure_schema, create_conversation, save_file, save_messages_bulk, get_conversation_messages
 from utils.llm import GroqLLMClient
 from utils.document_processor import DocumentProcessor
 import base64
 
-def load_custom_css():
-    """Load custom CSS styling for the application"""
-    st.markdown("""
+# Minimum time between streaming placeholder re-renders (seconds)
+STREAM_FLUSH_INTERVAL_S = 0.075
+# Flush earlier if this many characters have arrived since the last render
+STREAM_FLUSH_MIN_CHARS = 32
+# Number of most recent chat messages sent to the LLM as context
+CHAT_HISTORY_LIMIT = 20
+# Sentinel put on the chunk queue once the LLM stream is exhausted
+_STREAM_DONE = object()
+
+# Constant page styling, built once at import instead of on every rerun.
+# The font stylesheet is linked (with a preload hint) rather than @import-ed
+# so its fetch isn't serialized behind parsing of this style block.
+_CUSTOM_CSS = """
+    <link rel="preload" as="style" href="https://fonts.cdnfonts.com/css/tw-cen-mt-std">
+    <link rel="stylesheet" href="https://fonts.cdnfonts.com/css/tw-cen-mt-std">
     <style>
-    @import url('https://fonts.cdnfonts.com/css/tw-cen-mt-std');
-    
     * {
         font-family: 'Tw Cen MT Std', sans-serif !important;
     }
@@ -39,26 +53,6 @@ def load_custom_css():
         margin-bottom: 2rem;
     }
     
-    .message {
-        margin-bottom: 1rem;
-        padding: 1rem;
-        border-radius: 10px;
-        max-width: 80%;
-    }
-    
-    .user-message {
-        background: #2563eb;
-        color: white;
-        margin-left: auto;
-        text-align: right;
-    }
-    
-    .assistant-message {
-        background: #f3f4f6;
-        color: #1f2937;
-        margin-right: auto;
-    }
-    
     .file-upload {
         background: white;
         border-radius: 10px;
@@ -67,66 +61,6 @@ def load_custom_css():
         border: 2px dashed #d1d5db;
     }
     
-    .stTextInput > div > div > input {
-        border-radius: 12px;
-        border: 2px solid #e5e7eb;
-        padding: 12px 16px;
-        font-size: 16px;
-        transition: all 0.3s ease;
-    }
-    
-    .stTextInput > div > div > input:focus {
-        border-color: #2563eb;
-        box-shadow: 0 0 0 3px rgba(37, 99, 235, 0.1);
-    }
-    
-    .stButton > button {
-        background: #2563eb;
-        color: white;
-        border: none;
-        border-radius: 8px;
-        padding: 8px 16px;
-        font-weight: 600;
-        transition: all 0.3s ease;
-        width: 36px;
-        height: 36px;
-        display: flex;
-        align-items: center;
-        justify-content: center;
-    }
-    
-    .stButton > button:hover {
-        background: #1d4ed8;
-        transform: translateY(-1px);
-        box-shadow: 0 4px 12px rgba(37, 99, 235, 0.3);
-    }
-    
-    .streaming-response {
-        background: #f8fafc;
-        border-left: 4px solid #2563eb;
-        padding: 1rem;
-        margin: 1rem 0;
-        border-radius: 0 8px 8px 0;
-        font-family: 'Courier New', monospace;
-        font-size: 14px;
-        line-height: 1.5;
-    }
-    
-    .typing-indicator {
-        display: inline-block;
-        width: 8px;
-        height: 8px;
-        border-radius: 50%;
-        background: #2563eb;
-        animation: blink 1s infinite;
-        margin-left: 4px;
-    }
-    
-    @keyframes blink {
-        0%, 50% { opacity: 1; }
-        51%, 100% { opacity: 0; }
-    }
-    
     .file-info {
         background: #e0f2fe;
         border: 1px solid #0288d1;
@@ -154,7 +88,21 @@ def load_custom_css():
         margin: 1rem 0;
     }
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+def load_custom_css():
+    """Load custom CSS styling for the application"""
+    st.markdown(_CUSTOM_CSS, unsafe_allow_html=True)
+
+@st.cache_resource(show_spinner=False)
+def get_llm_client():
+    """Get the LLM client shared across all sessions"""
+    return GroqLLMClient()
+
+@st.cache_resource(show_spinner=False)
+def get_document_processor():
+    """Get the document processor shared across all sessions"""
+    return DocumentProcessor()
 
 def initialize_session_state():
     """Initialize session state variables"""
@@ -168,10 +116,18 @@ def initialize_session_state():
         st.session_state.messages = []
     
     if 'llm_client' not in st.session_state:
-        st.session_state.llm_client = GroqLLMClient()
+        st.session_state.llm_client = get_llm_client()
     
     if 'document_processor' not in st.session_state:
-        st.session_state.document_processor = DocumentProcessor()
+        st.session_state.document_processor = get_document_processor()
+
+def get_uploaded_bytes(uploaded_file):
+    """Read the uploaded file's bytes once per upload and cache them in session state"""
+    if st.session_state.get('uploaded_key') != uploaded_file.file_id:
+        st.session_state.uploaded_bytes = uploaded_file.getvalue()
+        st.session_state.uploaded_key = uploaded_file.file_id
+    
+    return st.session_state.uploaded_bytes
 
 def handle_file_upload(uploaded_file):
     """Process uploaded file and extract text content"""
@@ -179,8 +135,15 @@ def handle_file_upload(uploaded_file):
         return None, None
     
     try:
-        # Process the document
-        text_content = st.session_state.document_processor.process_document(uploaded_file)
+        # Extract once per upload; reruns reuse the text instead of re-processing the file
+        if st.session_state.get('extracted_key') != uploaded_file.file_id:
+            # Process a lightweight view over the cached bytes rather than the uploader object
+            file_buffer = io.BytesIO(get_uploaded_bytes(uploaded_file))
+            file_buffer.name = uploaded_file.name
+            st.session_state.extracted_text = st.session_state.document_processor.process_document(file_buffer)
+            st.session_state.extracted_key = uploaded_file.file_id
+        
+        text_content = st.session_state.extracted_text
         
         if text_content:
             # Create file info for display
@@ -196,55 +159,115 @@ def handle_file_upload(uploaded_file):
         st.error(f"Error processing file: {str(e)}")
         return None, f"❌ **Error**: {str(e)}"
 
+def persist_uploaded_file(uploaded_file):
+    """Store the uploaded file once per conversation and return its database ID"""
+    if st.session_state.get('stored_file_key') != uploaded_file.file_id:
+        st.session_state.stored_file_id = save_file(
+            st.session_state.conversation_id,
+            uploaded_file.name,
+            get_uploaded_bytes(uploaded_file)
+        )
+        st.session_state.stored_file_key = uploaded_file.file_id
+    
+    return st.session_state.stored_file_id
+
 def display_chat_history():
-    """Display the chat history with proper styling"""
+    """Display completed chat messages using Streamlit's native chat elements"""
     for message in st.session_state.messages:
-        if message["role"] == "user":
-            st.markdown(f"""
-            <div class="message user-message">
-                <strong>You:</strong><br>
-                {message["content"]}
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class="message assistant-message">
-                <strong>Assistant:</strong><br>
-                {message["content"]}
-            </div>
-            """, unsafe_allow_html=True)
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+def get_document_message(file_content):
+    """Build the system message carrying the document text once per upload"""
+    cached = st.session_state.get('document_message')
+    if cached is None or cached[0] != file_content:
+        cached = (file_content, {"role": "system", "content": f"Document Content:\n{file_content}"})
+        st.session_state.document_message = cached
+    
+    return cached[1]
 
-def stream_response(prompt, file_content=None):
-    """Stream the LLM response in real-time"""
+def build_chat_messages(file_content=None):
+    """Build the LLM message list: document as a stable system prefix, then recent history"""
+    messages = [get_document_message(file_content)] if file_content else []
+    messages.extend(st.session_state.messages[-CHAT_HISTORY_LIMIT:])
+    return messages
+
+def produce_response_chunks(llm_client, messages, chunk_queue, cancelled):
+    """Iterate the LLM stream in a worker thread, handing chunks to the script thread
+    
+    Errors are put on the queue for the script thread to re-raise, and the stream
+    is closed early once ``cancelled`` is set.
+    """
+    try:
+        stream = llm_client.chat_completion_stream(messages)
+        try:
+            for chunk in stream:
+                if cancelled.is_set():
+                    break
+                chunk_queue.put(chunk)
+        finally:
+            stream.close()
+    except BaseException as e:
+        chunk_queue.put(e)
+    finally:
+        chunk_queue.put(_STREAM_DONE)
+
+def stream_response(file_content=None):
+    """Stream the LLM response to the latest user message in real-time"""
     try:
-        # Prepare the full prompt
-        full_prompt = prompt
-        if file_content:
-            full_prompt += f"\n\nDocument Content:\n{file_content}"
-        
         # Create a placeholder for streaming
         response_placeholder = st.empty()
         
-        # Stream the response
-        response_text = ""
-        for chunk in st.session_state.llm_client.chat_completion_stream([
-            {"role": "user", "content": full_prompt}
-        ]):
-            if chunk and chunk.strip():
-                response_text += chunk
-                # Update the placeholder with current response and typing indicator
-                response_placeholder.markdown(f"""
-                <div class="streaming-response">
-                    {response_text}<span class="typing-indicator"></span>
-                </div>
-                """, unsafe_allow_html=True)
+        # Pull chunks from a worker thread so network waits don't block rendering
+        chunk_queue = queue.Queue()
+        cancelled = threading.Event()
+        producer = threading.Thread(
+            target=produce_response_chunks,
+            args=(
+                st.session_state.llm_client,
+                build_chat_messages(file_content),
+                chunk_queue,
+                cancelled
+            ),
+            daemon=True
+        )
+        producer.start()
+        
+        # Stream the response as plain text, batching re-renders so the
+        # buffer isn't re-sent on every token; markdown is rendered once at the end
+        response_parts = []
+        last_flush = time.monotonic()
+        pending_chars = 0
+        try:
+            while True:
+                try:
+                    chunk = chunk_queue.get(timeout=STREAM_FLUSH_INTERVAL_S)
+                except queue.Empty:
+                    pass
+                else:
+                    if chunk is _STREAM_DONE:
+                        break
+                    if isinstance(chunk, BaseException):
+                        raise chunk
+                    if chunk:
+                        response_parts.append(chunk)
+                        pending_chars += len(chunk)
+                
+                # Also flushes text left pending while the network is idle
+                now = time.monotonic()
+                if not pending_chars or (now - last_flush < STREAM_FLUSH_INTERVAL_S and pending_chars < STREAM_FLUSH_MIN_CHARS):
+                    continue
+                response_placeholder.text("".join(response_parts))
+                last_flush = now
+                pending_chars = 0
+        finally:
+            # Stop the producer if the script is stopped, reruns or hits an error
+            cancelled.set()
+        
+        response_text = "".join(response_parts)
         
-        # Final update without typing indicator
-        response_placeholder.markdown(f"""
-        <div class="streaming-response">
-            {response_text}
-        </div>
-        """, unsafe_allow_html=True)
+        # Final markdown render of the completed response
+        response_placeholder.markdown(response_text)
         
         return response_text
     
@@ -289,57 +312,49 @@ def main():
         if st.session_state.messages:
             display_chat_history()
         
+        # New turns are rendered in place here, between the history and the input
+        new_turn = st.container()
+        
         # Chat input
-        user_input = st.text_input(
-            "Ask me about your expense document or any expense-related questions:",
-            key="user_input",
-            placeholder="e.g., 'Analyze this expense report' or 'What are the total expenses?'"
+        user_input = st.chat_input(
+            "Ask me about your expense document or any expense-related questions"
         )
         
-        # Send button
-        col1, col2, col3 = st.columns([1, 0.1, 1])
-        with col2:
-            send_button = st.button("➤", key="send_button")
-        
         # Handle user input
-        if send_button and user_input:
+        if user_input:
             # Add user message to session
             st.session_state.messages.append({"role": "user", "content": user_input})
             
-            # Save to database if conversation exists
-            if st.session_state.conversation_id:
-                try:
-                    save_message(
-                        st.session_state.conversation_id,
-                        "user",
-                        user_input,
-                        uploaded_file.read() if uploaded_file else None
-                    )
-                except Exception as e:
-                    st.warning(f"Could not save message to database: {str(e)}")
-            
-            # Generate and stream response
-            with st.spinner("🤔 Thinking..."):
-                response = stream_response(user_input, file_content)
+            # Generate and stream response below the existing history
+            with new_turn:
+                with st.chat_message("user"):
+                    st.markdown(user_input)
+                with st.chat_message("assistant"):
+                    with st.spinner("🤔 Thinking..."):
+                        response = stream_response(file_content)
             
             if response:
                 # Add assistant response to session
                 st.session_state.messages.append({"role": "assistant", "content": response})
-                
-                # Save to database if conversation exists
-                if st.session_state.conversation_id:
-                    try:
-                        save_message(st.session_state.conversation_id, "assistant", response)
-                    except Exception as e:
-                        st.warning(f"Could not save response to database: {str(e)}")
             
-            # Clear input
-            st.session_state.user_input = ""
-            st.rerun()
+            # Save the user message and response together in one transaction
+            if st.session_state.conversation_id:
+                try:
+                    rows = [{
+                        "role": "user",
+                        "content": user_input,
+                        "file_id": persist_uploaded_file(uploaded_file) if uploaded_file else None
+                    }]
+                    if response:
+                        rows.append({"role": "assistant", "content": response})
+                    save_messages_bulk(st.session_state.conversation_id, rows)
+                except Exception as e:
+                    st.warning(f"Could not save messages to database: {str(e)}")
         
         # Initialize conversation in database
         if st.session_state.conversation_id is None:
             try:
+                ensure_schema()
                 st.session_state.conversation_id = create_conversation(st.session_state.session_id)
                 st.success("✅ Conversation initialized successfully!")
             except Exception as e:
@@ -1,19 +1,28 @@
 import os
 import logging
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, LargeBinary, ForeignKey, JSON
+from sqlalchemy import create_engine, func, text, Column, Integer, String, Text, DateTime, LargeBinary, ForeignKey, JSON, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.exc import SQLAlchemyError, OperationalError
 import time
 import ssl
+import threading
+from contextlib import contextmanager
+from utils.logging_config import configure_logging
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+# Engine and session factory are created once per process and shared
+_engine = None
+_SessionLocal = None
+_engine_lock = threading.Lock()
+_schema_ready = False
+
 class Conversation(Base):
     """Database model for storing conversation sessions"""
     __tablename__ = 'conversations'
@@ -22,21 +31,45 @@ class Conversation(Base):
     session_id = Column(String(255), unique=True, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    metadata = Column(JSON)
+    # "metadata" is reserved on declarative classes; keep it as the column name only
+    extra_metadata = Column("metadata", JSON)
     
     # Relationship to messages
-    messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
+    messages = relationship(
+        "Message",
+        back_populates="conversation",
+        cascade="all, delete-orphan",
+        order_by="Message.created_at"
+    )
+    files = relationship("StoredFile", back_populates="conversation", cascade="all, delete-orphan")
+
+class StoredFile(Base):
+    """Database model for storing an uploaded file once per conversation"""
+    __tablename__ = 'files'
+    
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(Integer, ForeignKey('conversations.id'), nullable=False)
+    filename = Column(String(255), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    data = Column(LargeBinary, nullable=False)
+    
+    # Relationship to conversation
+    conversation = relationship("Conversation", back_populates="files")
 
 class Message(Base):
     """Database model for storing individual chat messages"""
     __tablename__ = 'messages'
+    __table_args__ = (
+        # Serves the per-conversation history query as an ordered index range scan
+        Index('ix_messages_conv_created', 'conversation_id', 'created_at'),
+    )
     
     id = Column(Integer, primary_key=True)
     conversation_id = Column(Integer, ForeignKey('conversations.id'), nullable=False)
     role = Column(String(20), nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
-    file_data = Column(LargeBinary)  # For storing uploaded file data
+    file_id = Column(Integer, ForeignKey('files.id'))  # Uploaded file referenced by this message
     
     # Relationship to conversation
     conversation = relationship("Conversation", back_populates="messages")
@@ -75,215 +108,254 @@ def create_engine_with_retry(max_retries=3, retry_delay=1):
                 **ssl_args
             )
             
-            # Test the connection
+            # Test the connection once at startup; pool_pre_ping covers checkouts after that
             with engine.connect() as conn:
-                conn.execute("SELECT 1")
+                conn.execute(text("SELECT 1"))
             
             logger.info("Database connection established successfully")
             return engine
             
         except (OperationalError, SQLAlchemyError) as e:
-            logger.warning(f"Database connection attempt {attempt + 1} failed: {str(e)}")
+            logger.warning("Database connection attempt %s failed: %s", attempt + 1, e)
             if attempt < max_retries - 1:
                 time.sleep(retry_delay * (2 ** attempt))  # Exponential backoff
             else:
                 logger.error("Failed to establish database connection after all retries")
                 raise
 
+def get_engine():
+    """Get the shared SQLAlchemy engine, creating it on first use"""
+    global _engine, _SessionLocal
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = create_engine_with_retry()
+                _SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+                _engine = engine
+    return _engine
+
 def get_db_session():
     """Get database session with connection pooling"""
     try:
-        engine = create_engine_with_retry()
-        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-        return SessionLocal()
+        get_engine()
+        return _SessionLocal()
     except Exception as e:
-        logger.error(f"Error creating database session: {str(e)}")
+        logger.error("Error creating database session: %s", e)
         raise
 
 def create_tables():
     """Create database tables if they don't exist"""
     try:
-        engine = create_engine_with_retry()
-        Base.metadata.create_all(bind=engine)
+        Base.metadata.create_all(bind=get_engine())
         logger.info("Database tables created successfully")
     except Exception as e:
-        logger.error(f"Error creating database tables: {str(e)}")
+        logger.error("Error creating database tables: %s", e)
+        raise
+
+def ensure_schema():
+    """Create database tables once per process; callers must run this before other helpers"""
+    global _schema_ready
+    if not _schema_ready:
+        create_tables()
+        _schema_ready = True
+
+@contextmanager
+def session_scope():
+    """Provide a transactional session: commit on success, rollback on error"""
+    db = get_db_session()
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
         raise
+    finally:
+        db.close()
 
 def create_conversation(session_id, metadata=None):
     """Create a new conversation record"""
     try:
-        db = get_db_session()
-        conversation = Conversation(
-            session_id=session_id,
-            metadata=metadata or {}
-        )
-        db.add(conversation)
-        db.commit()
-        db.refresh(conversation)
-        logger.info(f"Created conversation with ID: {conversation.id}")
-        return conversation.id
+        with session_scope() as db:
+            conversation = Conversation(
+                session_id=session_id,
+                extra_metadata=metadata or {}
+            )
+            db.add(conversation)
+            db.flush()
+            conversation_id = conversation.id
+        logger.info("Created conversation with ID: %s", conversation_id)
+        return conversation_id
     except Exception as e:
-        logger.error(f"Error creating conversation: {str(e)}")
-        if db:
-            db.rollback()
+        logger.error("Error creating conversation: %s", e)
+        raise
+
+def save_file(conversation_id, filename, data):
+    """Store an uploaded file's bytes once and return its ID"""
+    try:
+        with session_scope() as db:
+            stored_file = StoredFile(
+                conversation_id=conversation_id,
+                filename=filename,
+                data=data
+            )
+            db.add(stored_file)
+            db.flush()
+            file_id = stored_file.id
+        logger.info("Saved file with ID: %s", file_id)
+        return file_id
+    except Exception as e:
+        logger.error("Error saving file: %s", e)
         raise
-    finally:
-        if db:
-            db.close()
 
-def save_message(conversation_id, role, content, file_data=None):
+def save_message(conversation_id, role, content, file_id=None):
     """Save a message to the database"""
     try:
-        db = get_db_session()
-        message = Message(
-            conversation_id=conversation_id,
-            role=role,
-            content=content,
-            file_data=file_data
-        )
-        db.add(message)
-        db.commit()
-        db.refresh(message)
-        logger.info(f"Saved message with ID: {message.id}")
-        return message.id
+        with session_scope() as db:
+            message = Message(
+                conversation_id=conversation_id,
+                role=role,
+                content=content,
+                file_id=file_id
+            )
+            db.add(message)
+            db.flush()
+            message_id = message.id
+        logger.info("Saved message with ID: %s", message_id)
+        return message_id
     except Exception as e:
-        logger.error(f"Error saving message: {str(e)}")
-        if db:
-            db.rollback()
+        logger.error("Error saving message: %s", e)
+        raise
+
+def save_messages_bulk(conversation_id, rows):
+    """Save several messages to the database in a single transaction"""
+    try:
+        with session_scope() as db:
+            messages = [
+                Message(
+                    conversation_id=conversation_id,
+                    role=row['role'],
+                    content=row['content'],
+                    file_id=row.get('file_id')
+                )
+                for row in rows
+            ]
+            db.add_all(messages)
+            db.flush()
+            message_ids = [message.id for message in messages]
+        logger.info("Saved messages with IDs: %s", message_ids)
+        return message_ids
+    except Exception as e:
+        logger.error("Error saving messages: %s", e)
         raise
-    finally:
-        if db:
-            db.close()
 
 def get_conversation_messages(conversation_id, limit=50):
     """Retrieve messages for a conversation"""
     try:
-        db = get_db_session()
-        messages = db.query(Message).filter(
-            Message.conversation_id == conversation_id
-        ).order_by(Message.created_at.asc()).limit(limit).all()
-        
-        return [
-            {
-                'id': msg.id,
-                'role': msg.role,
-                'content': msg.content,
-                'created_at': msg.created_at.isoformat(),
-                'file_data': msg.file_data
-            }
-            for msg in messages
-        ]
+        with session_scope() as db:
+            # Select only the needed columns to skip ORM object hydration
+            rows = db.query(
+                Message.id, Message.role, Message.content, Message.created_at, Message.file_id
+            ).filter(
+                Message.conversation_id == conversation_id
+            ).order_by(Message.created_at.asc()).limit(limit).all()
+            
+            return [
+                {
+                    'id': row.id,
+                    'role': row.role,
+                    'content': row.content,
+                    'created_at': row.created_at.isoformat(),
+                    'file_id': row.file_id
+                }
+                for row in rows
+            ]
     except Exception as e:
-        logger.error(f"Error retrieving conversation messages: {str(e)}")
+        logger.error("Error retrieving conversation messages: %s", e)
         return []
-    finally:
-        if db:
-            db.close()
+
+def get_message_file_data(message_id):
+    """Retrieve the uploaded file bytes attached to a message, if any"""
+    try:
+        with session_scope() as db:
+            return db.query(StoredFile.data).join(
+                Message, Message.file_id == StoredFile.id
+            ).filter(Message.id == message_id).scalar()
+    except Exception as e:
+        logger.error("Error retrieving message file data: %s", e)
+        return None
 
 def get_conversation_by_session_id(session_id):
     """Get conversation by session ID"""
     try:
-        db = get_db_session()
-        conversation = db.query(Conversation).filter(
-            Conversation.session_id == session_id
-        ).first()
-        
-        if conversation:
-            return {
-                'id': conversation.id,
-                'session_id': conversation.session_id,
-                'created_at': conversation.created_at.isoformat(),
-                'updated_at': conversation.updated_at.isoformat(),
-                'metadata': conversation.metadata
-            }
-        return None
+        with session_scope() as db:
+            conversation = db.query(Conversation).filter(
+                Conversation.session_id == session_id
+            ).first()
+            
+            if conversation:
+                return {
+                    'id': conversation.id,
+                    'session_id': conversation.session_id,
+                    'created_at': conversation.created_at.isoformat(),
+                    'updated_at': conversation.updated_at.isoformat(),
+                    'metadata': conversation.extra_metadata
+                }
+            return None
     except Exception as e:
-        logger.error(f"Error retrieving conversation: {str(e)}")
+        logger.error("Error retrieving conversation: %s", e)
         return None
-    finally:
-        if db:
-            db.close()
 
 def update_conversation_metadata(conversation_id, metadata):
     """Update conversation metadata"""
     try:
-        db = get_db_session()
-        conversation = db.query(Conversation).filter(
-            Conversation.id == conversation_id
-        ).first()
-        
-        if conversation:
-            conversation.metadata = metadata
+        with session_scope() as db:
+            conversation = db.query(Conversation).filter(
+                Conversation.id == conversation_id
+            ).first()
+            
+            if not conversation:
+                return False
+            conversation.extra_metadata = metadata
             conversation.updated_at = datetime.utcnow()
-            db.commit()
-            logger.info(f"Updated conversation metadata for ID: {conversation_id}")
-            return True
-        return False
+        logger.info("Updated conversation metadata for ID: %s", conversation_id)
+        return True
     except Exception as e:
-        logger.error(f"Error updating conversation metadata: {str(e)}")
-        if db:
-            db.rollback()
+        logger.error("Error updating conversation metadata: %s", e)
         return False
-    finally:
-        if db:
-            db.close()
 
 def delete_conversation(conversation_id):
     """Delete a conversation and all its messages"""
     try:
-        db = get_db_session()
-        conversation = db.query(Conversation).filter(
-            Conversation.id == conversation_id
-        ).first()
-        
-        if conversation:
+        with session_scope() as db:
+            conversation = db.query(Conversation).filter(
+                Conversation.id == conversation_id
+            ).first()
+            
+            if not conversation:
+                return False
             db.delete(conversation)
-            db.commit()
-            logger.info(f"Deleted conversation with ID: {conversation_id}")
-            return True
-        return False
+        logger.info("Deleted conversation with ID: %s", conversation_id)
+        return True
     except Exception as e:
-        logger.error(f"Error deleting conversation: {str(e)}")
-        if db:
-            db.rollback()
+        logger.error("Error deleting conversation: %s", e)
         return False
-    finally:
-        if db:
-            db.close()
 
 def get_conversation_stats(conversation_id):
     """Get statistics for a conversation"""
     try:
-        db = get_db_session()
-        message_count = db.query(Message).filter(
-            Message.conversation_id == conversation_id
-        ).count()
-        
-        user_messages = db.query(Message).filter(
-            Message.conversation_id == conversation_id,
-            Message.role == 'user'
-        ).count()
-        
-        assistant_messages = db.query(Message).filter(
-            Message.conversation_id == conversation_id,
-            Message.role == 'assistant'
-        ).count()
+        with session_scope() as db:
+            # One grouped aggregate instead of a COUNT query per role
+            counts = dict(
+                db.query(Message.role, func.count(Message.id)).filter(
+                    Message.conversation_id == conversation_id
+                ).group_by(Message.role).all()
+            )
         
         return {
-            'total_messages': message_count,
-            'user_messages': user_messages,
-            'assistant_messages': assistant_messages
+            'total_messages': sum(counts.values()),
+            'user_messages': counts.get('user', 0),
+            'assistant_messages': counts.get('assistant', 0)
         }
     except Exception as e:
-        logger.error(f"Error getting conversation stats: {str(e)}")
+        logger.error("Error getting conversation stats: %s", e)
         return None
-    finally:
-        if db:
-            db.close()
-
-# Initialize database tables on module import
-try:
-    create_tables()
-except Exception as e:
-    logger.warning(f"Could not initialize database tables: {str(e)}")
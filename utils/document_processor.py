@@ -2,24 +2,176 @@ import os
 import logging
 from typing import Optional, Union
 import io
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
 from PIL import Image
+from charset_normalizer import from_bytes
+from charset_normalizer.utils import is_multi_byte_encoding
+import pypdfium2 as pdfium
 import pdfplumber
 import PyPDF2
+from utils.logging_config import configure_logging
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
+# Uploads larger than this are spooled to a temporary file before extraction
+SPOOL_MAX_MEMORY_BYTES = 4 * 1024 * 1024
+
+# Bytes inspected when sniffing the encoding of non-UTF-8 text files
+ENCODING_SNIFF_BYTES = 64 * 1024
+# Single-byte encoding guesses less coherent than this fall back to cp1252
+ENCODING_MIN_COHERENCE = 0.2
+
+# PDFs below both limits go straight to PyPDF2 when PDFium yields nothing
+SMALL_PDF_MAX_PAGES = 2
+SMALL_PDF_MAX_BYTES = 500 * 1024
+
+# PDFs with more pages than this are extracted across worker processes
+PARALLEL_PAGE_THRESHOLD = 4
+
+# Extensions rejected outright as potentially executable
+_SUSPICIOUS_EXTS = frozenset({'.exe', '.bat', '.cmd', '.com', '.scr', '.vbs', '.js'})
+
+# Leading bytes that identify a format category regardless of file name
+_MAGIC_SIGNATURES = (
+    (b'%PDF-', 'pdf'),
+    (b'\x89PNG', 'image'),
+    (b'\xff\xd8\xff', 'image'),  # JPEG
+    (b'GIF8', 'image'),
+    (b'II*\x00', 'image'),  # TIFF, little-endian
+    (b'MM\x00*', 'image'),  # TIFF, big-endian
+)
+
+# Generic container formats (ZIP, OLE2) that hold spreadsheets but also
+# .docx, .pptx, .doc, plain archives, etc.
+_CONTAINER_SIGNATURES = (b'PK\x03\x04', b'\xd0\xcf\x11\xe0')
+
+def _detect_category(head: bytes, ext_category: Optional[str]) -> Optional[str]:
+    """Detect a format category from a file's leading bytes and its extension's category
+    
+    Specific signatures override the extension; a container signature only
+    counts as a spreadsheet when the extension agrees.
+    """
+    for signature, category in _MAGIC_SIGNATURES:
+        if head.startswith(signature):
+            return category
+    if head.startswith(_CONTAINER_SIGNATURES):
+        return ext_category if ext_category == 'spreadsheet' else None
+    return ext_category
+
+def _looks_like_utf8(window: bytes) -> bool:
+    """Check whether bytes are mostly valid UTF-8, with only a few stray bytes"""
+    text = window.decode('utf-8', 'replace')
+    invalid = text.count('\ufffd')
+    non_ascii = len(text) - len(text.encode('ascii', 'ignore'))
+    return non_ascii - invalid > invalid
+
+def _guess_encoding(window: bytes) -> str:
+    """Guess the encoding of text that failed strict UTF-8 decoding
+    
+    Western text is the common case, so cp1252 wins ties and replaces
+    low-confidence single-byte guesses.
+    """
+    if _looks_like_utf8(window):
+        return 'utf-8'
+    
+    matches = from_bytes(window)
+    best_match = matches.best()
+    if best_match is None or best_match.encoding == 'ascii':
+        return 'cp1252'
+    if best_match.encoding == 'utf_8':
+        return 'utf-8'
+    if any('cp1252' in match.could_be_from_charset for match in matches if match.chaos <= best_match.chaos):
+        return 'cp1252'
+    if not is_multi_byte_encoding(best_match.encoding) and best_match.coherence < ENCODING_MIN_COHERENCE:
+        return 'cp1252'
+    return best_match.encoding
+
+def _file_size(file_obj) -> int:
+    """Get a file's size by seeking to its end, without reading any data"""
+    position = file_obj.tell()
+    file_obj.seek(0, io.SEEK_END)
+    size = file_obj.tell()
+    file_obj.seek(position)
+    return size
+
+def _pages_to_text(pages, layout: bool = False) -> str:
+    """Concatenate pdfplumber page text, releasing each page's layout caches as we go
+    
+    Without ``layout``, pages use extract_text_simple(), which only groups characters
+    into lines and skips the word/gap clustering of extract_text().
+    """
+    buffer = io.StringIO()
+    for page in pages:
+        page_text = page.extract_text() if layout else page.extract_text_simple()
+        if page_text:
+            buffer.write(page_text)
+            buffer.write("\n\n")
+        page.close()
+    return buffer.getvalue().strip()
+
+def _extract_page_range(pdf_path: str, start: int, stop: int, layout: bool = False) -> str:
+    """Extract text from a range of PDF pages (runs in a worker process)"""
+    with pdfplumber.open(pdf_path) as pdf:
+        return _pages_to_text(pdf.pages[start:stop], layout)
+
+# Worker pool for parallel PDF extraction, shared by all callers and created on first use.
+# Workers come from a forkserver rather than fork(): the app process runs several
+# threads, and a forked child could inherit a lock held by one of them and deadlock.
+_pdf_executor = None
+_pdf_executor_lock = threading.Lock()
+
+def _get_pdf_executor() -> ProcessPoolExecutor:
+    """Get the shared PDF extraction process pool, starting it on first use"""
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is None:
+            _pdf_executor = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context("forkserver")
+            )
+    return _pdf_executor
+
+def _discard_pdf_executor(executor: ProcessPoolExecutor) -> None:
+    """Drop a broken PDF process pool so the next caller starts a fresh one"""
+    global _pdf_executor
+    with _pdf_executor_lock:
+        if _pdf_executor is executor:
+            _pdf_executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
 class DocumentProcessor:
     """Multi-format document text extraction with fallback mechanisms"""
     
     def __init__(self):
         """Initialize the document processor"""
         self.supported_formats = {
-            'pdf': ['.pdf'],
-            'image': ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff'],
-            'text': ['.txt', '.csv', '.md'],
-            'spreadsheet': ['.xlsx', '.xls', '.ods']
+            'pdf': frozenset({'.pdf'}),
+            'image': frozenset({'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff'}),
+            'text': frozenset({'.txt', '.csv', '.md'}),
+            'spreadsheet': frozenset({'.xlsx', '.xls', '.ods'})
+        }
+        
+        # Reverse lookup: extension -> format category
+        self._ext_to_category = {
+            ext: category
+            for category, extensions in self.supported_formats.items()
+            for ext in extensions
+        }
+        
+        # Extraction method for each format category
+        self._handlers = {
+            'pdf': self.extract_text_from_pdf,
+            'image': self.extract_text_from_image,
+            'text': self.extract_text_from_file,
+            'spreadsheet': self.extract_text_from_spreadsheet
         }
         
         self.max_file_size = 50 * 1024 * 1024  # 50MB limit
@@ -32,74 +184,154 @@ class DocumentProcessor:
             if not self._validate_file(uploaded_file):
                 return None
             
-            # Determine file type and process accordingly
-            file_extension = self._get_file_extension(uploaded_file.name)
-            
-            if file_extension in self.supported_formats['pdf']:
-                return self.extract_text_from_pdf(uploaded_file)
-            
-            elif file_extension in self.supported_formats['image']:
-                return self.extract_text_from_image(uploaded_file)
-            
-            elif file_extension in self.supported_formats['text']:
-                return self.extract_text_from_file(uploaded_file)
-            
-            elif file_extension in self.supported_formats['spreadsheet']:
-                return self.extract_text_from_spreadsheet(uploaded_file)
+            # Determine file type from its magic bytes, falling back to the extension
+            head = uploaded_file.read(16)
+            uploaded_file.seek(0)
+            category = _detect_category(
+                head, self._ext_to_category.get(self._get_file_extension(uploaded_file.name))
+            )
+            handler = self._handlers.get(category)
+            if handler is None or _file_size(uploaded_file) <= SPOOL_MAX_MEMORY_BYTES:
+                return (handler or self._unsupported)(uploaded_file)
             
-            else:
-                logger.warning(f"Unsupported file format: {file_extension}")
-                return f"Unsupported file format: {file_extension}. Please upload a PDF, image, or text file."
+            # Extract large uploads from a spooled copy on disk so the extractors'
+            # working memory stays bounded when several uploads run at once
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY_BYTES) as spool:
+                shutil.copyfileobj(uploaded_file, spool)
+                spool.seek(0)
+                return handler(spool)
                 
         except Exception as e:
-            logger.error(f"Error processing document: {str(e)}")
+            logger.error("Error processing document: %s", e)
             return f"Error processing document: {str(e)}"
     
-    def extract_text_from_pdf(self, uploaded_file) -> Optional[str]:
-        """Extract text from PDF using pdfplumber with PyPDF2 fallback"""
+    def extract_text_from_pdf(self, uploaded_file, layout: bool = False) -> Optional[str]:
+        """Extract text from PDF using PDFium, with pdfplumber and PyPDF2 fallbacks
+        
+        Set ``layout`` to go straight to pdfplumber's layout-aware extraction (e.g. for tables).
+        """
         try:
-            # Try pdfplumber first (better text extraction)
-            try:
-                with pdfplumber.open(uploaded_file) as pdf:
-                    text_content = []
-                    for page in pdf.pages:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text_content.append(page_text.strip())
+            # Try PDFium first (C++ engine, much faster than the pure-Python backends)
+            if not layout:
+                try:
+                    text_content = self._extract_pdfium(uploaded_file)
+                    if text_content:
+                        logger.info("Successfully extracted text using PDFium")
+                        return text_content
+                except Exception as e:
+                    logger.warning("PDFium failed: %s, trying pdfplumber fallback", e)
+                uploaded_file.seek(0)  # Reset file pointer
+            
+            # Then pdfplumber (layout-aware text extraction); small PDFs skip its
+            # heavy layout engine since PyPDF2 handles them adequately
+            if layout or not self._is_small_pdf(uploaded_file):
+                try:
+                    with pdfplumber.open(uploaded_file) as pdf:
+                        page_count = len(pdf.pages)
+                        if not page_count:
+                            logger.warning("PDF has no pages")
+                            return "No text content could be extracted from this PDF file."
+                        
+                        if page_count <= PARALLEL_PAGE_THRESHOLD:
+                            text_content = _pages_to_text(pdf.pages, layout)
+                    
+                    # Layout analysis is CPU-bound pure Python, so larger files are
+                    # split into page ranges and extracted in separate processes
+                    if page_count > PARALLEL_PAGE_THRESHOLD:
+                        text_content = self._extract_pdf_parallel(uploaded_file, page_count, layout)
                     
                     if text_content:
                         logger.info("Successfully extracted text using pdfplumber")
-                        return "\n\n".join(text_content)
-                
-            except Exception as e:
-                logger.warning(f"pdfplumber failed: {str(e)}, trying PyPDF2 fallback")
+                        return text_content
+                    
+                except Exception as e:
+                    logger.warning("pdfplumber failed: %s, trying PyPDF2 fallback", e)
             
             # Fallback to PyPDF2
             try:
                 uploaded_file.seek(0)  # Reset file pointer
                 pdf_reader = PyPDF2.PdfReader(uploaded_file)
-                text_content = []
+                buffer = io.StringIO()
                 
                 for page in pdf_reader.pages:
                     page_text = page.extract_text()
                     if page_text:
-                        text_content.append(page_text.strip())
+                        buffer.write(page_text)
+                        buffer.write("\n\n")
                 
+                text_content = buffer.getvalue().strip()
                 if text_content:
                     logger.info("Successfully extracted text using PyPDF2 fallback")
-                    return "\n\n".join(text_content)
+                    return text_content
                 else:
                     logger.warning("No text content found in PDF")
                     return "No text content could be extracted from this PDF file."
                     
             except Exception as e:
-                logger.error(f"PyPDF2 fallback also failed: {str(e)}")
+                logger.error("PyPDF2 fallback also failed: %s", e)
                 return f"Error extracting text from PDF: {str(e)}"
                 
         except Exception as e:
-            logger.error(f"Unexpected error in PDF processing: {str(e)}")
+            logger.error("Unexpected error in PDF processing: %s", e)
             return f"Error processing PDF file: {str(e)}"
     
+    def _is_small_pdf(self, uploaded_file) -> bool:
+        """Check whether a PDF is small enough that pdfplumber isn't worth loading"""
+        try:
+            if _file_size(uploaded_file) > SMALL_PDF_MAX_BYTES:
+                return False
+            return len(PyPDF2.PdfReader(uploaded_file).pages) <= SMALL_PDF_MAX_PAGES
+        except Exception:
+            return False
+        finally:
+            uploaded_file.seek(0)
+    
+    def _extract_pdfium(self, uploaded_file) -> str:
+        """Extract PDF text with pypdfium2"""
+        pdf = pdfium.PdfDocument(uploaded_file)
+        try:
+            buffer = io.StringIO()
+            for page in pdf:
+                textpage = page.get_textpage()
+                page_text = textpage.get_text_range()
+                textpage.close()
+                page.close()
+                if page_text:
+                    buffer.write(page_text)
+                    buffer.write("\n\n")
+            return buffer.getvalue().replace("\r\n", "\n").strip()
+        finally:
+            pdf.close()
+    
+    def _extract_pdf_parallel(self, uploaded_file, page_count: int, layout: bool = False) -> str:
+        """Extract PDF text with pdfplumber across worker processes, one page range each"""
+        # Hand workers a file path rather than pickling the PDF bytes into every task
+        uploaded_file.seek(0)
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
+            shutil.copyfileobj(uploaded_file, pdf_file)
+        
+        try:
+            workers = min(os.cpu_count() or 1, page_count)
+            step = -(-page_count // workers)
+            starts = range(0, page_count, step)
+            stops = [min(start + step, page_count) for start in starts]
+            
+            executor = _get_pdf_executor()
+            try:
+                parts = list(executor.map(
+                    _extract_page_range, repeat(pdf_file.name), starts, stops, repeat(layout)
+                ))
+            except BrokenProcessPool:
+                # A worker died (e.g. killed out of memory); replace the pool and retry once
+                logger.warning("PDF worker pool broke, restarting it")
+                _discard_pdf_executor(executor)
+                parts = _get_pdf_executor().map(
+                    _extract_page_range, repeat(pdf_file.name), starts, stops, repeat(layout)
+                )
+            return "\n\n".join(part for part in parts if part)
+        finally:
+            os.unlink(pdf_file.name)
+    
     def extract_text_from_image(self, uploaded_file) -> Optional[str]:
         """Extract text from image (placeholder for future OCR implementation)"""
         try:
@@ -116,36 +348,45 @@ class DocumentProcessor:
             # return text
             
         except Exception as e:
-            logger.error(f"Error processing image: {str(e)}")
+            logger.error("Error processing image: %s", e)
             return f"Error processing image file: {str(e)}"
     
     def extract_text_from_file(self, uploaded_file) -> Optional[str]:
         """Extract text from text-based files"""
         try:
-            # Read the file content
-            content = uploaded_file.read()
-            
-            # Try to decode as UTF-8
+            # Try to decode as UTF-8 (the common case), straight from the file
+            # handle instead of materializing a bytes copy
             try:
-                text_content = content.decode('utf-8')
-            except UnicodeDecodeError:
-                # Fallback to other encodings
-                try:
-                    text_content = content.decode('latin-1')
-                except UnicodeDecodeError:
-                    text_content = content.decode('cp1252', errors='ignore')
+                text_content = self._read_text(uploaded_file, 'utf-8', 'strict')
+            except UnicodeDecodeError as e:
+                # Sniff a bounded window around the first non-UTF-8 byte, keeping
+                # some context before it. TextIOWrapper.read() decodes the whole
+                # stream in one call, so the error offset is a file offset.
+                uploaded_file.seek(max(0, e.start - ENCODING_SNIFF_BYTES // 2))
+                encoding = _guess_encoding(uploaded_file.read(ENCODING_SNIFF_BYTES))
+                uploaded_file.seek(0)
+                text_content = self._read_text(uploaded_file, encoding, 'replace')
             
-            if text_content.strip():
+            text_content = text_content.strip()
+            if text_content:
                 logger.info("Successfully extracted text from file")
-                return text_content.strip()
+                return text_content
             else:
                 logger.warning("Empty text content in file")
                 return "The uploaded file appears to be empty."
                 
         except Exception as e:
-            logger.error(f"Error extracting text from file: {str(e)}")
+            logger.error("Error extracting text from file: %s", e)
             return f"Error reading file content: {str(e)}"
     
+    def _read_text(self, uploaded_file, encoding: str, errors: str) -> str:
+        """Decode a binary file handle through a TextIOWrapper"""
+        reader = io.TextIOWrapper(uploaded_file, encoding=encoding, errors=errors, newline='')
+        try:
+            return reader.read()
+        finally:
+            reader.detach()  # Leave the caller's file handle open
+    
     def extract_text_from_spreadsheet(self, uploaded_file) -> Optional[str]:
         """Extract text from spreadsheet files (placeholder for future implementation)"""
         try:
@@ -160,15 +401,22 @@ class DocumentProcessor:
             # return df.to_string()
             
         except Exception as e:
-            logger.error(f"Error processing spreadsheet: {str(e)}")
+            logger.error("Error processing spreadsheet: %s", e)
             return f"Error processing spreadsheet file: {str(e)}"
     
+    def _unsupported(self, uploaded_file) -> str:
+        """Handle files whose format has no extraction method"""
+        file_extension = self._get_file_extension(uploaded_file.name)
+        logger.warning("Unsupported file format: %s", file_extension)
+        return f"Unsupported file format: {file_extension}. Please upload a PDF, image, or text file."
+    
     def _validate_file(self, uploaded_file) -> bool:
         """Validate uploaded file for security and format"""
         try:
             # Check file size
-            if uploaded_file.size > self.max_file_size:
-                logger.warning(f"File too large: {uploaded_file.size} bytes")
+            file_size = _file_size(uploaded_file)
+            if file_size > self.max_file_size:
+                logger.warning("File too large: %d bytes", file_size)
                 return False
             
             # Check file name
@@ -177,16 +425,15 @@ class DocumentProcessor:
                 return False
             
             # Check for suspicious file extensions
-            suspicious_extensions = ['.exe', '.bat', '.cmd', '.com', '.scr', '.vbs', '.js']
             file_extension = self._get_file_extension(uploaded_file.name)
-            if file_extension.lower() in suspicious_extensions:
-                logger.warning(f"Suspicious file extension: {file_extension}")
+            if file_extension in _SUSPICIOUS_EXTS:
+                logger.warning("Suspicious file extension: %s", file_extension)
                 return False
             
             return True
             
         except Exception as e:
-            logger.error(f"Error validating file: {str(e)}")
+            logger.error("Error validating file: %s", e)
             return False
     
     def _get_file_extension(self, filename: str) -> str:
@@ -202,8 +449,4 @@ class DocumentProcessor:
     
     def is_format_supported(self, filename: str) -> bool:
         """Check if a file format is supported"""
-        file_extension = self._get_file_extension(filename)
-        for format_list in self.supported_formats.values():
-            if file_extension in format_list:
-                return True
-        return False
+        return self._get_file_extension(filename) in self._ext_to_category
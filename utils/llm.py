@@ -1,17 +1,90 @@
 import os
 import logging
 import time
-from typing import List, Dict, Any, Generator
+import asyncio
+import threading
+import hashlib
+import random
+from collections import OrderedDict
+import httpx
+import orjson
+from typing import List, Dict, Any, Generator, AsyncGenerator, Optional
 import groq
 from groq import GroqError, RateLimitError, APIError
+from groq import _streaming as groq_streaming
+from utils.logging_config import configure_logging
 
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
+def _use_orjson_for_sse():
+    """Decode Groq's streamed SSE payloads with orjson instead of the stdlib json module"""
+    sse_class = getattr(groq_streaming, 'ServerSentEvent', None)
+    if sse_class is None or not callable(getattr(sse_class, 'json', None)):
+        logger.warning("Groq SDK SSE event class not found; keeping stdlib JSON decoding")
+        return
+    sse_class.json = lambda self: orjson.loads(self.data)
+
+_use_orjson_for_sse()
+
+# Number of streamed tokens joined into each chunk handed to callers
+STREAM_BATCH_TOKENS = 8
+
+# Connection pooling for the Groq HTTP clients; keep-alive avoids a TLS handshake per request
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=40)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+# How long a connection test result is reused before probing the API again
+CONNECTION_TEST_TTL_S = 60
+
+# Completed responses kept for repeated identical requests
+RESPONSE_CACHE_SIZE = 256
+# Requests above this temperature are too non-deterministic to serve from cache
+CACHEABLE_MAX_TEMPERATURE = 0.3
+
+# Proactive request pacing so bursts are smoothed before the API answers with 429s
+RATE_LIMIT_REQUESTS = 30
+RATE_LIMIT_PERIOD_S = 60
+
+class TokenBucket:
+    """Token-bucket request pacer usable from both threads and coroutines"""
+    
+    def __init__(self, rate: int, period: float):
+        """Allow ``rate`` requests per ``period`` seconds, with bursts up to ``rate``"""
+        self.capacity = rate
+        self.fill_rate = rate / period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _reserve(self) -> float:
+        """Take a token and return how long to wait before it is actually available"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.fill_rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.fill_rate)
+    
+    def acquire(self):
+        """Block the calling thread until a request may be sent"""
+        wait_time = self._reserve()
+        if wait_time:
+            time.sleep(wait_time)
+    
+    async def acquire_async(self):
+        """Wait without blocking the event loop until a request may be sent"""
+        wait_time = self._reserve()
+        if wait_time:
+            await asyncio.sleep(wait_time)
+
 class GroqLLMClient:
     """Wrapper class for Groq LLM API with streaming support and error handling"""
     
+    # Shared by all instances, since Groq rate limits apply per API key
+    _bucket = TokenBucket(RATE_LIMIT_REQUESTS, RATE_LIMIT_PERIOD_S)
+    
     def __init__(self, api_key: str = None, model: str = None):
         """Initialize the Groq LLM client"""
         self.api_key = api_key or os.getenv('GROQ_API_KEY')
@@ -19,7 +92,18 @@ class GroqLLMClient:
             raise ValueError("GROQ_API_KEY environment variable is required")
         
         self.model = model or os.getenv('GROQ_MODEL', 'llama-3.3-70b-versatile')
-        self.client = groq.Groq(api_key=self.api_key)
+        self.client = groq.Groq(
+            api_key=self.api_key,
+            http_client=httpx.Client(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+        )
+        self.aclient = groq.AsyncGroq(
+            api_key=self.api_key,
+            http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+        )
+        
+        # Background event loop driving the async client for synchronous callers
+        self._loop = None
+        self._loop_lock = threading.Lock()
         
         # Configuration
         self.max_retries = 3
@@ -27,37 +111,81 @@ class GroqLLMClient:
         self.max_tokens = 4096
         self.temperature = 0.7
         
-        logger.info(f"Initialized Groq LLM client with model: {self.model}")
+        # Most recent connection test result and when it was taken
+        self._conn_ok = None
+        self._conn_ok_ts = 0.0
+        
+        # LRU cache of completed responses, shared by all threads using this client
+        self._response_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        
+        logger.info("Initialized Groq LLM client with model: %s", self.model)
     
     def chat_completion(self, messages: List[Dict[str, str]], **kwargs) -> str:
         """Generate a chat completion response"""
+        max_tokens = kwargs.get('max_tokens', self.max_tokens)
+        temperature = kwargs.get('temperature', self.temperature)
+        
         try:
+            # Serve repeated low-temperature requests from cache
+            cache_key = None
+            if temperature <= CACHEABLE_MAX_TEMPERATURE:
+                cache_key = self._cache_key(messages, max_tokens, temperature)
+            if cache_key is not None:
+                with self._cache_lock:
+                    cached = self._response_cache.get(cache_key)
+                    if cached is not None:
+                        self._response_cache.move_to_end(cache_key)
+                        return cached
+            
+            self._bucket.acquire()
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
-                max_tokens=kwargs.get('max_tokens', self.max_tokens),
-                temperature=kwargs.get('temperature', self.temperature),
+                max_tokens=max_tokens,
+                temperature=temperature,
                 stream=False
             )
             
-            return self._validate_response(response)
+            content = self._validate_response(response)
+            if cache_key is not None and response.choices and response.choices[0].message.content:
+                with self._cache_lock:
+                    self._response_cache[cache_key] = content
+                    if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+                        self._response_cache.popitem(last=False)
+            return content
             
         except RateLimitError as e:
-            logger.warning(f"Rate limit exceeded: {str(e)}")
-            return self._handle_rate_limit(messages, **kwargs)
+            logger.warning("Rate limit exceeded: %s", e)
+            return self._handle_rate_limit(messages, self._retry_after(e), **kwargs)
             
         except APIError as e:
-            logger.error(f"API error: {str(e)}")
+            logger.error("API error: %s", e)
             return self._handle_api_error(e, messages, **kwargs)
             
         except Exception as e:
-            logger.error(f"Unexpected error in chat completion: {str(e)}")
+            logger.error("Unexpected error in chat completion: %s", e)
             return f"I apologize, but I encountered an error: {str(e)}"
     
     def chat_completion_stream(self, messages: List[Dict[str, str]], **kwargs) -> Generator[str, None, None]:
         """Generate a streaming chat completion response"""
+        loop = self._get_loop()
+        stream = self.chat_completion_stream_async(messages, **kwargs)
         try:
-            response = self.client.chat.completions.create(
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(stream.__anext__(), loop).result()
+                except StopAsyncIteration:
+                    break
+        finally:
+            asyncio.run_coroutine_threadsafe(stream.aclose(), loop).result()
+    
+    async def chat_completion_stream_async(self, messages: List[Dict[str, str]], **kwargs) -> AsyncGenerator[str, None]:
+        """Generate a streaming chat completion response, yielding batches of tokens"""
+        batch = []
+        try:
+            await self._bucket.acquire_async()
+            response = await self.aclient.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 max_tokens=kwargs.get('max_tokens', self.max_tokens),
@@ -65,22 +193,61 @@ class GroqLLMClient:
                 stream=True
             )
             
-            for chunk in response:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+            async for chunk in response:
+                content = chunk.choices[0].delta.content
+                if content:
+                    batch.append(content)
+                    if len(batch) >= STREAM_BATCH_TOKENS:
+                        yield "".join(batch)
+                        batch.clear()
+            
+            if batch:
+                yield "".join(batch)
                     
         except RateLimitError as e:
-            logger.warning(f"Rate limit exceeded during streaming: {str(e)}")
-            yield self._handle_rate_limit(messages, **kwargs)
+            logger.warning("Rate limit exceeded during streaming: %s", e)
+            if batch:
+                yield "".join(batch)
+            yield await self._handle_rate_limit_async(messages, self._retry_after(e), **kwargs)
             
         except APIError as e:
-            logger.error(f"API error during streaming: {str(e)}")
+            logger.error("API error during streaming: %s", e)
+            if batch:
+                yield "".join(batch)
             yield self._handle_api_error(e, messages, **kwargs)
             
         except Exception as e:
-            logger.error(f"Unexpected error in streaming completion: {str(e)}")
+            logger.error("Unexpected error in streaming completion: %s", e)
+            if batch:
+                yield "".join(batch)
             yield f"I apologize, but I encountered an error: {str(e)}"
     
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """Get the background event loop for the async client, starting it on first use"""
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="groq-event-loop", daemon=True).start()
+                self._loop = loop
+        return self._loop
+    
+    def _cache_key(self, messages: List[Dict[str, str]], max_tokens: int, temperature: float) -> Optional[tuple]:
+        """Build a compact response cache key from request parameters and message digests
+        
+        Returns None (don't cache) unless every message content is a plain string.
+        """
+        if not all(isinstance(m.get('content'), str) for m in messages):
+            return None
+        return (
+            self.model,
+            temperature,
+            max_tokens,
+            tuple(
+                (m['role'], hashlib.blake2b(m['content'].encode(), digest_size=16).digest())
+                for m in messages
+            )
+        )
+    
     def _validate_response(self, response) -> str:
         """Validate and extract content from API response"""
         try:
@@ -96,17 +263,32 @@ class GroqLLMClient:
                 return "I apologize, but I received an invalid response format."
                 
         except Exception as e:
-            logger.error(f"Error validating response: {str(e)}")
+            logger.error("Error validating response: %s", e)
             return "I apologize, but I encountered an error processing the response."
     
-    def _handle_rate_limit(self, messages: List[Dict[str, str]], **kwargs) -> str:
+    def _retry_after(self, error: RateLimitError) -> float:
+        """Read the server's Retry-After hint (in seconds) from a rate limit error"""
+        response = getattr(error, 'response', None)
+        if response is None:
+            return 0.0
+        try:
+            return float(response.headers.get('retry-after', 0))
+        except (TypeError, ValueError):
+            return 0.0
+    
+    def _rate_limit_wait(self, attempt: int, retry_after: float) -> float:
+        """Compute the wait before a retry: exponential backoff or the server's hint, plus jitter"""
+        return max(retry_after, self.retry_delay * (2 ** attempt)) + random.uniform(0, 0.5)
+    
+    def _handle_rate_limit(self, messages: List[Dict[str, str]], retry_after: float = 0.0, **kwargs) -> str:
         """Handle rate limit errors with exponential backoff"""
         for attempt in range(self.max_retries):
             try:
-                wait_time = self.retry_delay * (2 ** attempt)
-                logger.info(f"Rate limited, waiting {wait_time} seconds before retry {attempt + 1}")
+                wait_time = self._rate_limit_wait(attempt, retry_after)
+                logger.info("Rate limited, waiting %.2f seconds before retry %s", wait_time, attempt + 1)
                 time.sleep(wait_time)
                 
+                self._bucket.acquire()
                 response = self.client.chat.completions.create(
                     model=self.model,
                     messages=messages,
@@ -117,12 +299,43 @@ class GroqLLMClient:
                 
                 return self._validate_response(response)
                 
-            except RateLimitError:
+            except RateLimitError as e:
                 if attempt == self.max_retries - 1:
                     return "I apologize, but I'm currently experiencing high demand. Please try again in a few moments."
+                retry_after = self._retry_after(e)
                 continue
             except Exception as e:
-                logger.error(f"Error during rate limit retry: {str(e)}")
+                logger.error("Error during rate limit retry: %s", e)
+                return f"I apologize, but I encountered an error: {str(e)}"
+        
+        return "I apologize, but I'm currently experiencing high demand. Please try again in a few moments."
+    
+    async def _handle_rate_limit_async(self, messages: List[Dict[str, str]], retry_after: float = 0.0, **kwargs) -> str:
+        """Handle rate limit errors with exponential backoff without blocking the event loop"""
+        for attempt in range(self.max_retries):
+            try:
+                wait_time = self._rate_limit_wait(attempt, retry_after)
+                logger.info("Rate limited, waiting %.2f seconds before retry %s", wait_time, attempt + 1)
+                await asyncio.sleep(wait_time)
+                
+                await self._bucket.acquire_async()
+                response = await self.aclient.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    max_tokens=kwargs.get('max_tokens', self.max_tokens),
+                    temperature=kwargs.get('temperature', self.temperature),
+                    stream=False
+                )
+                
+                return self._validate_response(response)
+                
+            except RateLimitError as e:
+                if attempt == self.max_retries - 1:
+                    return "I apologize, but I'm currently experiencing high demand. Please try again in a few moments."
+                retry_after = self._retry_after(e)
+                continue
+            except Exception as e:
+                logger.error("Error during rate limit retry: %s", e)
                 return f"I apologize, but I encountered an error: {str(e)}"
         
         return "I apologize, but I'm currently experiencing high demand. Please try again in a few moments."
@@ -144,11 +357,11 @@ class GroqLLMClient:
             return "I apologize, but I'm currently experiencing high demand. Please try again in a few moments."
         
         elif error_code >= 500:
-            logger.error(f"Server error: {error_code}")
+            logger.error("Server error: %s", error_code)
             return "I apologize, but the service is currently experiencing technical difficulties. Please try again later."
         
         else:
-            logger.error(f"API error {error_code}: {str(error)}")
+            logger.error("API error %s: %s", error_code, error)
             return f"I apologize, but I encountered an error: {str(error)}"
     
     def get_model_info(self) -> Dict[str, Any]:
@@ -169,12 +382,22 @@ class GroqLLMClient:
         if 'model' in kwargs:
             self.model = kwargs['model']
         
-        logger.info(f"Updated configuration: {kwargs}")
+        logger.info("Updated configuration: %s", kwargs)
     
     def test_connection(self) -> bool:
-        """Test the connection to the Groq API"""
+        """Test the connection to the Groq API, reusing a recent result"""
+        if self._conn_ok is not None and time.monotonic() - self._conn_ok_ts < CONNECTION_TEST_TTL_S:
+            return self._conn_ok
+        
+        self._conn_ok = self._probe_connection()
+        self._conn_ok_ts = time.monotonic()
+        return self._conn_ok
+    
+    def _probe_connection(self) -> bool:
+        """Send a minimal request to check that the Groq API is reachable"""
         try:
             # Simple test with minimal tokens
+            self._bucket.acquire()
             response = self.client.chat.completions.create(
                 model=self.model,
                 messages=[{"role": "user", "content": "Hello"}],
@@ -190,5 +413,5 @@ class GroqLLMClient:
                 return False
                 
         except Exception as e:
-            logger.error(f"Groq API connection test failed: {str(e)}")
+            logger.error("Groq API connection test failed: %s", e)
             return False
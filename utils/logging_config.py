@@ -0,0 +1,13 @@
+import os
+import logging
+
+def configure_logging():
+    """Configure root logging once; set LOG_FORMAT=json for JSON-lines output"""
+    if os.getenv('LOG_FORMAT', '').lower() == 'json':
+        from pythonjsonlogger.json import JsonFormatter
+        
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter('%(asctime)s %(name)s %(levelname)s %(message)s'))
+        logging.basicConfig(level=logging.INFO, handlers=[handler])
+    else:
+        logging.basicConfig(level=logging.INFO)